@@ -1,34 +1,78 @@
-from flask import Flask, request, render_template_string, send_from_directory, jsonify
-from PIL import Image, ImageDraw
+from flask import Flask, request, jsonify
+from PIL import Image, ImageDraw, ImageFont
 from prometheus_flask_exporter import PrometheusMetrics
 from PIL.ExifTags import TAGS
-from inference_sdk import InferenceHTTPClient, InferenceConfiguration
-from inference_sdk.http.errors import HTTPCallErrorError
-import os, uuid, json, random, io, threading, time
+import os, uuid, json, io, threading, time, functools, zlib, base64
+import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 from flask_cors import CORS
+from whitenoise import WhiteNoise
 try:
     from pillow_heif import register_heif_opener
     register_heif_opener()
     HEIC_SUPPORT = True
 except ImportError:
     HEIC_SUPPORT = False
+try:
+    from numba import njit
+    NUMBA_SUPPORT = True
+except ImportError:
+    NUMBA_SUPPORT = False
+try:
+    import pyvips
+    # Only useful if this libvips build has a HEIF loader at all
+    VIPS_SUPPORT = pyvips.type_find("VipsForeignLoad", "heifload_buffer") != 0
+except (ImportError, OSError):
+    # OSError: the pyvips wheel is installed but libvips itself is missing
+    VIPS_SUPPORT = False
 
 API_KEY = os.environ.get("ROBOFLOW_API_KEY")
 PROJECT_ID = "corn-hub/4"
-UPLOAD_FOLDER = "uploads"
 RESULT_FOLDER = "results"
-CLIENT = InferenceHTTPClient(api_url="https://detect.roboflow.com", api_key=API_KEY)
+MAX_PIXELS = 1920 * 1920
+NMS_MAX_CANDIDATES = 3000
+API_URL = "https://detect.roboflow.com"
+CONFIDENCE_THRESHOLD = 0.10
 
-CLIENT.configure(InferenceConfiguration(confidence_threshold=0.10))
+# inference_sdk goes through requests.post, which opens a new connection (and
+# TLS handshake) per call; one pooled session keeps connections alive instead
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+try:
+    LABEL_FONT = ImageFont.truetype("DejaVuSans.ttf", 12)
+except OSError:
+    LABEL_FONT = ImageFont.load_default()
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULT_FOLDER, exist_ok=True)
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
 CORS(app)
 
-progress_store = {}
+def add_cors_header(headers, path, url):
+    # WhiteNoise answers before Flask, so flask_cors never sees these responses
+    headers["Access-Control-Allow-Origin"] = "*"
+
+# Files already in RESULT_FOLDER are indexed at startup; new results are added by
+# save_result(), so lookups stay in WhiteNoise's in-memory dict (no autorefresh)
+RESULT_FILES = WhiteNoise(app.wsgi_app, root=RESULT_FOLDER, prefix="results/",
+                          add_headers_function=add_cors_header)
+app.wsgi_app = RESULT_FILES
+
+# Abandoned or failed jobs are never polled to completion; the TTL evicts them
+progress_store = TTLCache(maxsize=1024, ttl=3600)
+progress_lock = threading.Lock()
+
+# Bounded pool caps concurrent Roboflow calls and reuses worker threads
+WORKERS = int(os.environ.get("WORKERS", 8))
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKERS)
+# submit() never blocks and its queue is unbounded, and every queued job holds
+# its upload in memory; slots cap running + queued jobs so /analyze can shed load
+JOB_SLOTS = threading.BoundedSemaphore(int(os.environ.get("MAX_PENDING_JOBS", WORKERS * 4)))
 
 USDA_GRADES = [
     ("U.S. No. 1", 3.0, 1, 0.1, 0),
@@ -38,42 +82,123 @@ USDA_GRADES = [
     ("U.S. No. 5", 15.0, 7, 3.0, 1)
 ]
 
-def non_max_suppression(predictions, iou_threshold=0.3):
-    boxes = []
-    for pred in predictions:
-        x0 = pred['x'] - pred['width'] / 2
-        y0 = pred['y'] - pred['height'] / 2
-        x1 = pred['x'] + pred['width'] / 2
-        y1 = pred['y'] + pred['height'] / 2
-        boxes.append((x0, y0, x1, y1, pred['confidence'], pred['class']))
-
-    boxes = sorted(boxes, key=lambda b: b[4], reverse=True)
+DAMAGE_CLASSES = frozenset({
+    "Blue-eye Mold damage", "Drier damage", "Insect damage",
+    "Mold damage", "Sprout damage", "Surface Mold", "cracked"
+})
+HEAT_DAMAGE_CLASSES = frozenset({"Heat damage"})
+
+CLASS_COLORS = {
+    "Normal": "blue",
+    "Mold damage": "red",
+    "Blue-eye Mold damage": "darkred"
+}
+
+@functools.lru_cache(maxsize=None)
+def color_for(label):
+    if label in CLASS_COLORS:
+        return CLASS_COLORS[label]
+    # crc32 rather than hash(): str hashes are salted per process
+    return "#%06x" % (zlib.crc32(label.encode()) & 0xFFFFFF)
+
+def prediction_arrays(predictions):
+    boxes = np.array([
+        [p['x'] - p['width'] / 2, p['y'] - p['height'] / 2,
+         p['x'] + p['width'] / 2, p['y'] + p['height'] / 2]
+        for p in predictions
+    ], dtype=np.float32).reshape(-1, 4)
+    scores = np.fromiter((p['confidence'] for p in predictions), dtype=np.float32, count=len(predictions))
+    classes = np.array([p['class'] for p in predictions], dtype=object)
+    return boxes, scores, classes
+
+def nms_numpy(boxes, order, iou_threshold):
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
     keep = []
 
-    while boxes:
-        chosen = boxes.pop(0)
-        keep.append(chosen)
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
         # Remove boxes that overlap with chosen, regardless of class
-        boxes = [box for box in boxes if iou(box, chosen) < iou_threshold]
-
-    return [ {
-        'x': (b[0]+b[2])/2,
-        'y': (b[1]+b[3])/2,
-        'width': b[2]-b[0],
-        'height': b[3]-b[1],
-        'confidence': b[4],
-        'class': b[5]
-    } for b in keep ]
-
-def iou(boxA, boxB):
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-    interArea = max(0, xB - xA) * max(0, yB - yA)
-    boxAArea = (boxA[2] - boxA[0]) * (boxA[3] - boxA[1])
-    boxBArea = (boxB[2] - boxB[0]) * (boxB[3] - boxB[1])
-    return interArea / float(boxAArea + boxBArea - interArea)
+        xx1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.maximum(0, xx2 - xx1) * np.maximum(0, yy2 - yy1)
+        # iou < t  <=>  inter < t * union, for positive-area boxes; avoids the divide
+        union = areas[i] + areas[rest] - inter
+        order = rest[inter < iou_threshold * union]
+
+    return np.array(keep, dtype=np.intp)
+
+if NUMBA_SUPPORT:
+    @njit(cache=True)
+    def nms_numba(boxes, order, iou_threshold):
+        # Same algorithm as nms_numpy, but suppression is tracked in place
+        # instead of allocating new index/IoU arrays every round
+        n = order.shape[0]
+        suppressed = np.zeros(n, dtype=np.bool_)
+        keep = np.empty(n, dtype=np.intp)
+        count = 0
+        for a in range(n):
+            if suppressed[a]:
+                continue
+            i = order[a]
+            keep[count] = i
+            count += 1
+            area_i = (boxes[i, 2] - boxes[i, 0]) * (boxes[i, 3] - boxes[i, 1])
+            for b in range(a + 1, n):
+                if suppressed[b]:
+                    continue
+                j = order[b]
+                w = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+                h = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+                inter = max(w, 0.0) * max(h, 0.0)
+                union = area_i + (boxes[j, 2] - boxes[j, 0]) * (boxes[j, 3] - boxes[j, 1]) - inter
+                if not inter < iou_threshold * union:
+                    suppressed[b] = True
+        return keep[:count]
+
+    # Compile (or load from the on-disk cache) at import, not on the first request
+    nms_numba(np.zeros((1, 4), dtype=np.float32), np.zeros(1, dtype=np.intp), 0.3)
+
+def non_max_suppression(boxes, scores, iou_threshold=0.3, max_candidates=NMS_MAX_CANDIDATES):
+    # Limits N^2 blowup when the detector emits huge numbers of low-threshold boxes
+    order = np.argsort(-scores, kind='stable')[:max_candidates]
+    if NUMBA_SUPPORT:
+        return nms_numba(boxes, order, iou_threshold)
+    return nms_numpy(boxes, order, iou_threshold)
+
+def set_progress(progress_id, **fields):
+    with progress_lock:
+        entry = progress_store.get(progress_id)
+        if entry is not None:
+            entry.update(fields)
+
+class InferenceHTTPError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class InferenceConnectionError(Exception):
+    pass
+
+def infer(jpeg_bytes):
+    # requests puts the full URL, api_key included, into its exception messages,
+    # and these messages end up in /progress errors, so only sanitized ones escape
+    try:
+        response = SESSION.post(
+            f"{API_URL}/{PROJECT_ID}",
+            params={"api_key": API_KEY, "confidence": CONFIDENCE_THRESHOLD},
+            data=base64.b64encode(jpeg_bytes),
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            timeout=60,
+        )
+    except requests.RequestException as e:
+        raise InferenceConnectionError(f"Inference request failed: {type(e).__name__}") from None
+    if not response.ok:
+        raise InferenceHTTPError(response.status_code, f"Inference request failed with status {response.status_code}")
+    return response.json()
 
 def classify_grade(damage_pct, damage_kernels, heat_pct, heat_kernels, total_kernels):
     if total_kernels < 100:
@@ -86,112 +211,143 @@ def classify_grade(damage_pct, damage_kernels, heat_pct, heat_kernels, total_ker
                 return grade
     return "Sample Grade"
 
-def compress_image(image_path, max_size_mb=5, quality=85, progress_id=None):
+def save_result(img, filename):
+    output_path = os.path.join(RESULT_FOLDER, filename)
+    img.save(output_path)
+    # Register only once the file is fully written, so it is never served partial
+    RESULT_FILES.add_file_to_dictionary("/results/" + filename, output_path)
+
+def vips_thumbnail(image_bytes):
+    # libvips shrinks while decoding, so a 48MP HEIC never lands in memory full size
+    header = pyvips.Image.new_from_buffer(image_bytes, "")
+    ratio = min(1.0, (MAX_PIXELS / (header.width * header.height)) ** 0.5)
+    im = pyvips.Image.thumbnail_buffer(image_bytes, int(header.width * ratio),
+                                       height=int(header.height * ratio), size="down")
+    if im.hasalpha():
+        im = im.flatten(background=255)
+    im = im.colourspace("srgb").cast("uchar")
+    return Image.frombytes("RGB", (im.width, im.height), im.write_to_memory())
+
+def compress_image(image_bytes, max_size_mb=5, quality=85, progress_id=None, force_encode=False):
     def update_progress(step, total):
         progress = int((step / total) * 30) + 10
-        if progress_id and progress_id in progress_store:
-            progress_store[progress_id]['progress'] = progress
+        if progress_id:
+            set_progress(progress_id, progress=progress)
+    
+    max_bytes = max_size_mb * 1024 * 1024
     
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        original_size = img.size
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Already an in-budget RGB JPEG: decode it for drawing but skip the re-encode.
+        # Not when EXIF says it is rotated: Roboflow auto-orients, so its boxes would
+        # not line up with the unrotated pixels we draw on
+        if (not force_encode and len(image_bytes) <= max_bytes
+                and img.format == 'JPEG' and img.mode == 'RGB'
+                and img.size[0] * img.size[1] <= MAX_PIXELS
+                and img.getexif().get(0x0112, 1) == 1):
+            img.load()
+            update_progress(5, 5)
+            return img, image_bytes
+
+        if VIPS_SUPPORT and img.format == 'HEIF':
+            try:
+                img = vips_thumbnail(image_bytes)
+            except pyvips.Error:
+                # libheif without an HEVC decoder (e.g. AVIF-only builds) can't read
+                # HEIC; pillow-heif already opened it, so decode with that instead
+                img = img.convert("RGB")
+        else:
+            img = img.convert("RGB")
         
         update_progress(1, 5)
         
-        target_pixels = 1920 * 1920
+        # Downscale before any encode so no full-resolution JPEG is ever written
         current_pixels = img.size[0] * img.size[1]
         
-        if current_pixels > target_pixels:
-            ratio = (target_pixels / current_pixels) ** 0.5
+        if current_pixels > MAX_PIXELS:
+            ratio = (MAX_PIXELS / current_pixels) ** 0.5
             new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
             img = img.resize(new_size, Image.Resampling.LANCZOS)
             update_progress(2, 5)
         
-        for attempt in range(3):
+        def encode(q):
             buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=quality, optimize=True)
-            size_mb = buffer.tell() / (1024 * 1024)
-            update_progress(3 + attempt, 5)
-            
-            if size_mb <= max_size_mb or quality <= 20:
-                with open(image_path, 'wb') as f:
-                    f.write(buffer.getvalue())
-                return size_mb
-            
-            quality = max(20, quality - 20)
-
-def process_image_async(filepath, filename, moisture, weight, progress_id):
+            # 4:2:0 chroma and no exif= argument, so metadata is dropped from the upload.
+            # Fast-path JPEGs skip this and keep theirs, but only when Orientation is unset/1
+            img.save(buffer, format='JPEG', quality=q, optimize=True, progressive=True, subsampling=2)
+            return buffer.getvalue()
+
+        jpeg_bytes = encode(quality)
+        update_progress(3, 5)
+
+        if len(jpeg_bytes) > max_bytes:
+            # Two bisection probes over [20, quality], keeping the best encode that fits,
+            # so the worst case stays at three encodes. If the first probe is still too
+            # big, the second goes straight to the quality-20 floor, which is the
+            # fallback anyway
+            best = None
+            lo, hi = 20, quality
+            for probe in range(2):
+                mid = lo if probe == 1 and best is None else (lo + hi) // 2
+                data = encode(mid)
+                if len(data) <= max_bytes:
+                    lo, best = mid, data
+                else:
+                    hi = mid
+            jpeg_bytes = best if best is not None else data
+            update_progress(4, 5)
+
+        update_progress(5, 5)
+        return img, jpeg_bytes
+
+def process_image_async(image_bytes, filename, moisture, weight, progress_id):
     try:
-        progress_store[progress_id] = {'progress': 0, 'status': 'processing', 'result': None, 'error': None}
-        progress_store[progress_id]['progress'] = 5
+        set_progress(progress_id, progress=5)
         
-        compress_image(filepath, progress_id=progress_id)
-        progress_store[progress_id]['progress'] = 40
+        img, jpeg_bytes = compress_image(image_bytes, progress_id=progress_id)
+        set_progress(progress_id, progress=40)
         
         try:
-            raw_result = CLIENT.infer(filepath, model_id=PROJECT_ID)
-            progress_store[progress_id]['progress'] = 70
-        except HTTPCallErrorError as e:
+            raw_result = infer(jpeg_bytes)
+            set_progress(progress_id, progress=70)
+        except InferenceHTTPError as e:
             if e.status_code == 413:
-                compress_image(filepath, max_size_mb=2, progress_id=progress_id)
+                img, jpeg_bytes = compress_image(jpeg_bytes, max_size_mb=2, progress_id=progress_id, force_encode=True)
                 try:
-                    raw_result = CLIENT.infer(filepath, model_id=PROJECT_ID)
-                    progress_store[progress_id]['progress'] = 70
-                except HTTPCallErrorError as retry_error:
+                    raw_result = infer(jpeg_bytes)
+                    set_progress(progress_id, progress=70)
+                except InferenceHTTPError as retry_error:
                     if retry_error.status_code == 413:
-                        progress_store[progress_id]['error'] = "Image too large after compression"
-                        progress_store[progress_id]['status'] = 'error'
+                        set_progress(progress_id, error="Image too large after compression", status='error')
                         return
                     raise retry_error
             else:
                 raise e
 
-        result = raw_result.copy()
-        result['predictions'] = non_max_suppression(result['predictions'])
-        progress_store[progress_id]['progress'] = 80
+        boxes, scores, classes = prediction_arrays(raw_result['predictions'])
+        keep = non_max_suppression(boxes, scores)
+        boxes, labels = boxes[keep].tolist(), classes[keep].tolist()
+        set_progress(progress_id, progress=80)
 
-        img = Image.open(filepath).convert("RGB")
         draw = ImageDraw.Draw(img)
 
-        damage_classes = [
-            "Blue-eye Mold damage", "Drier damage", "Insect damage",
-            "Mold damage", "Sprout damage", "Surface Mold", "cracked"
-        ]
-        heat_damage_classes = ["Heat damage"]
-        class_colors = {
-            "Normal": "blue",
-            "Mold damage": "red",
-            "Blue-eye Mold damage": "darkred"
-        }
-
-        counts = {}
-        for pred in result['predictions']:
-            label = pred['class']
-            counts[label] = counts.get(label, 0) + 1
-            if label not in class_colors:
-                class_colors[label] = "#%06x" % random.randint(0, 0xFFFFFF)
-
-            color = class_colors[label]
-            x0 = pred['x'] - pred['width'] / 2
-            y0 = pred['y'] - pred['height'] / 2
-            x1 = pred['x'] + pred['width'] / 2
-            y1 = pred['y'] + pred['height'] / 2
+        counts = Counter(labels)
+        for (x0, y0, x1, y1), label in zip(boxes, labels):
+            color = color_for(label)
             draw.rectangle([x0, y0, x1, y1], outline=color, width=2)
-            draw.text((x0, y0 - 10), label, fill=color)
+            draw.text((x0, y0 - 10), label, fill=color, font=LABEL_FONT)
 
         normal_count = counts.get("Normal", 0)
         total_kernels = sum(counts.values())
         damage_kernels = total_kernels - normal_count
 
         total_damage_pct = (damage_kernels / total_kernels) * 100 if total_kernels else 0
-        heat_damage_count = sum(counts.get(c, 0) for c in heat_damage_classes)
+        heat_damage_count = sum(v for k, v in counts.items() if k in HEAT_DAMAGE_CLASSES)
         heat_damage_pct = (heat_damage_count / total_kernels) * 100 if total_kernels else 0
 
         grade = classify_grade(total_damage_pct, damage_kernels, heat_damage_pct, heat_damage_count, total_kernels)
 
-        output_path = os.path.join(RESULT_FOLDER, filename)
-        img.save(output_path)
-        progress_store[progress_id]['progress'] = 90
+        save_result(img, filename)
+        set_progress(progress_id, progress=90)
 
         result_data = {
             'counts': counts,
@@ -203,13 +359,12 @@ def process_image_async(filepath, filename, moisture, weight, progress_id):
             'raw_result': raw_result
         }
         
-        progress_store[progress_id]['result'] = result_data
-        progress_store[progress_id]['progress'] = 100
-        progress_store[progress_id]['status'] = 'completed'
+        set_progress(progress_id, result=result_data, progress=100, status='completed')
         
     except Exception as e:
-        progress_store[progress_id]['error'] = str(e)
-        progress_store[progress_id]['status'] = 'error'
+        set_progress(progress_id, error=str(e), status='error')
+    finally:
+        JOB_SLOTS.release()
 
 @app.route("/analyze", methods=["POST"])
 def analyze():
@@ -224,26 +379,57 @@ def analyze():
         return jsonify({'error': 'HEIC files not supported. Install pillow-heif.'}), 400
         
     filename = str(uuid.uuid4()) + ('.jpg' if file_ext in ['.heic', '.heif'] else file_ext)
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(filepath)
     
-    thread = threading.Thread(target=process_image_async, args=(filepath, filename, moisture, weight, progress_id))
-    thread.start()
+    if not JOB_SLOTS.acquire(blocking=False):
+        return jsonify({'error': 'Server busy, please retry shortly.'}), 503
+    
+    try:
+        image_bytes = file.read()
+        with progress_lock:
+            progress_store[progress_id] = {'progress': 0, 'status': 'processing', 'result': None, 'error': None}
+        EXECUTOR.submit(process_image_async, image_bytes, filename, moisture, weight, progress_id)
+    except Exception:
+        JOB_SLOTS.release()
+        raise
     
     return jsonify({'progress_id': progress_id})
 
 @app.route("/progress/<progress_id>")
 def get_progress(progress_id):
-    if progress_id not in progress_store:
-        return jsonify({'error': 'Invalid progress ID'}), 404
-    
-    data = progress_store[progress_id].copy()
-    
-    if data['status'] == 'completed' and progress_id in progress_store:
-        del progress_store[progress_id]
+    with progress_lock:
+        entry = progress_store.get(progress_id)
+        if entry is None:
+            return jsonify({'error': 'Invalid progress ID'}), 404
+        data = entry.copy()
+        if data['status'] == 'completed':
+            del progress_store[progress_id]
     
     return jsonify(data)
 
+RESULT_TEMPLATE = app.jinja_env.from_string('''
+    <div style="display: flex; flex-direction: row; gap: 40px;">
+        <div style="flex: 1;">
+            <h1>Analysis Result</h1>
+            <ul>
+                {% for label, count in counts.items() %}
+                    <li>{{ label }}: {{ count }}</li>
+                {% endfor %}
+            </ul>
+            <p><strong>Total Kernels:</strong> {{ total_kernels }}</p>
+            <p><strong>Grade:</strong> {{ grade }}</p>
+            <p><strong>Total damage %:</strong> {{ total_damage_pct | round(2) }}%</p>
+            <p><strong>Heat damage %:</strong> {{ heat_damage_pct | round(2) }}%</p>
+            <h2>Visual</h2>
+            <img src="https://corn-grader-backend.synventra.com/results/{{ filename }}" style="max-width: 100%; height: auto;">
+        </div>
+        <div style="flex: 1;">
+            <h2><button onclick="this.nextElementSibling.style.display='block'">Show Raw JSON</button></h2>
+            <pre style="display: none">{{ raw_result | tojson(indent=2) }}</pre>
+        </div>
+    </div>
+    <p><a href="/">Back</a></p>
+''')
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
@@ -256,93 +442,47 @@ def index():
             return f"<h1>Error: HEIC files not supported</h1><p>Please install pillow-heif or convert to JPG/PNG.</p><a href='/'>Back</a>"
 
         filename = str(uuid.uuid4()) + ('.jpg' if file_ext in ['.heic', '.heif'] else file_ext)
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
-
-        compress_image(filepath)
+        img, jpeg_bytes = compress_image(file.read())
 
         try:
-            raw_result = CLIENT.infer(filepath, model_id=PROJECT_ID)
-        except HTTPCallErrorError as e:
+            raw_result = infer(jpeg_bytes)
+        except InferenceHTTPError as e:
             if e.status_code == 413:
-                compress_image(filepath, max_size_mb=2)
+                img, jpeg_bytes = compress_image(jpeg_bytes, max_size_mb=2, force_encode=True)
                 try:
-                    raw_result = CLIENT.infer(filepath, model_id=PROJECT_ID)
-                except HTTPCallErrorError as retry_error:
+                    raw_result = infer(jpeg_bytes)
+                except InferenceHTTPError as retry_error:
                     if retry_error.status_code == 413:
                         return f"<h1>Error: Image too large</h1><p>Please upload a smaller image file.</p><a href='/'>Back</a>"
                     raise retry_error
             else:
                 raise e
-        result = raw_result.copy()
-        result['predictions'] = non_max_suppression(result['predictions'])
+        boxes, scores, classes = prediction_arrays(raw_result['predictions'])
+        keep = non_max_suppression(boxes, scores)
+        boxes, labels = boxes[keep].tolist(), classes[keep].tolist()
 
-        img = Image.open(filepath).convert("RGB")
         draw = ImageDraw.Draw(img)
 
-        damage_classes = [
-            "Blue-eye Mold damage", "Drier damage", "Insect damage",
-            "Mold damage", "Sprout damage", "Surface Mold", "cracked"
-        ]
-        heat_damage_classes = ["Heat damage"]
-        class_colors = {
-            "Normal": "blue",
-            "Mold damage": "red",
-            "Blue-eye Mold damage": "darkred"
-        }
-
-        counts = {}
-        for pred in result['predictions']:
-            label = pred['class']
-            counts[label] = counts.get(label, 0) + 1
-            if label not in class_colors:
-                class_colors[label] = "#%06x" % random.randint(0, 0xFFFFFF)
-
-            color = class_colors[label]
-            x0 = pred['x'] - pred['width'] / 2
-            y0 = pred['y'] - pred['height'] / 2
-            x1 = pred['x'] + pred['width'] / 2
-            y1 = pred['y'] + pred['height'] / 2
+        counts = Counter(labels)
+        for (x0, y0, x1, y1), label in zip(boxes, labels):
+            color = color_for(label)
             draw.rectangle([x0, y0, x1, y1], outline=color, width=2)
-            draw.text((x0, y0 - 10), label, fill=color)
+            draw.text((x0, y0 - 10), label, fill=color, font=LABEL_FONT)
 
         normal_count = counts.get("Normal", 0)
         total_kernels = sum(counts.values())
         damage_kernels = total_kernels - normal_count
 
         total_damage_pct = (damage_kernels / total_kernels) * 100 if total_kernels else 0
-        heat_damage_count = sum(counts.get(c, 0) for c in heat_damage_classes)
+        heat_damage_count = sum(v for k, v in counts.items() if k in HEAT_DAMAGE_CLASSES)
         heat_damage_pct = (heat_damage_count / total_kernels) * 100 if total_kernels else 0
 
         grade = classify_grade(total_damage_pct, damage_kernels, heat_damage_pct, heat_damage_count, total_kernels)
 
-        output_path = os.path.join(RESULT_FOLDER, filename)
-        img.save(output_path)
-
-        return render_template_string('''
-            <div style="display: flex; flex-direction: row; gap: 40px;">
-                <div style="flex: 1;">
-                    <h1>Analysis Result</h1>
-                    <ul>
-                        {% for label, count in counts.items() %}
-                            <li>{{ label }}: {{ count }}</li>
-                        {% endfor %}
-                    </ul>
-                    <p><strong>Total Kernels:</strong> {{ total_kernels }}</p>
-                    <p><strong>Grade:</strong> {{ grade }}</p>
-                    <p><strong>Total damage %:</strong> {{ total_damage_pct | round(2) }}%</p>
-                    <p><strong>Heat damage %:</strong> {{ heat_damage_pct | round(2) }}%</p>
-                    <h2>Visual</h2>
-                    <img src="https://corn-grader-backend.synventra.com/results/{{ filename }}" style="max-width: 100%; height: auto;">
-                </div>
-                <div style="flex: 1;">
-                    <h2><button onclick="this.nextElementSibling.style.display='block'">Show Raw JSON</button></h2>
-                    <pre style="display: none">{{ raw_result | tojson(indent=2) }}</pre>
-                </div>
-            </div>
-            <p><a href="/">Back</a></p>
-        ''', counts=counts, grade=grade, total_damage_pct=total_damage_pct,
-             heat_damage_pct=heat_damage_pct, filename=filename, raw_result=raw_result, total_kernels=total_kernels)
+        save_result(img, filename)
+
+        return RESULT_TEMPLATE.render(counts=counts, grade=grade, total_damage_pct=total_damage_pct,
+                                      heat_damage_pct=heat_damage_pct, filename=filename, raw_result=raw_result, total_kernels=total_kernels)
 
     return '''
         <h1>Upload Corn Kernel Image</h1>
@@ -354,10 +494,6 @@ def index():
         </form>
     '''
 
-@app.route("/results/<filename>")
-def result_image(filename):
-    return send_from_directory(RESULT_FOLDER, filename)
-
 if __name__ == "__main__":
     from waitress import serve
     serve(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))